@@ -16,19 +16,42 @@ except:
     # handling exception
 """
 import json
+import time
+import contextlib
+import contextvars
 import typing as t
+import threading
 import configparser
 
+from collections import defaultdict
+from http.client import HTTPException
+from concurrent.futures import Future, ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from urllib.request import urlopen
 from urllib.parse import urlencode
 
-from exceptions import TildaException
+from exceptions import TildaException, TildaCircuitOpenException, TildaDeadlineExceeded
+from resilience import LatencyTracker, CircuitBreaker, LRUCache
+from bulk import Deadline, BulkResult, SyncResult
+from tracing import Tracer, traced_get
+from scheduler import RequestScheduler, BULK, priority
 
 
 class TildaApi:
 
     TILDA_API_DOMEN = 'https://api.tildacdn.info/v1/'
     TIMEOUT = 5
+    # hedged requests: second identical request is sent after p95 latency of the endpoint
+    HEDGE_PERCENTILE = 95
+    HEDGE_DEFAULT_DELAY = 1.0  # used until enough latencies are collected
+    HEDGE_MIN_DELAY = 0.05
+    # circuit breaker settings
+    CIRCUIT_FAILURE_THRESHOLD = 5
+    CIRCUIT_RECOVERY_TIMEOUT = 30
+    # number of last successful results kept to be returned while circuit is open
+    FALLBACK_CACHE_SIZE = 256
+    # number of parallel requests in bulk operations
+    BULK_WORKERS = 4
     # API functions names
     GET_PROJECTS_LIST = 'getprojectslist'
     GET_PROJECT_INFO = 'getprojectinfo'
@@ -38,11 +61,16 @@ class TildaApi:
     GET_PAGE_EXPORT = 'getpageexport'
     GET_PAGE_FULL_EXPORT = 'getpagefullexport'
 
-    def __init__(self):
+    def __init__(self, hedge_requests: bool = False, circuit_breaker: bool = False, tracer: Tracer = None,
+                 scheduler: RequestScheduler = None):
         """
         Read config and define values for Tilda publickey and Tilda secretkey
 
         Чтение конфига. Инициализация переменных, содержащих значение publickey и secretkey
+        :param hedge_requests: bool - send a second identical request if the first one is slower than p95
+        :param circuit_breaker: bool - fail fast (or return last cached result) while an endpoint keeps failing
+        :param tracer: Tracer - record spans with timing of every phase of requests (optional)
+        :param scheduler: RequestScheduler - send requests through priority queue with shared rate limit (optional)
         """
         config = configparser.ConfigParser()
         config.read('settings.ini')
@@ -58,45 +86,175 @@ class TildaApi:
                                     self.GET_PAGE_EXPORT,
                                     self.GET_PAGE_FULL_EXPORT
                             ]
+        self.hedge_requests = hedge_requests
+        self.circuit_breaker = circuit_breaker
+        self.tracer = tracer
+        self.scheduler = scheduler
+        self._latencies = defaultdict(LatencyTracker)
+        self._circuit_breakers = defaultdict(lambda: CircuitBreaker(
+            failure_threshold=self.CIRCUIT_FAILURE_THRESHOLD,
+            recovery_timeout=self.CIRCUIT_RECOVERY_TIMEOUT
+        ))
+        # last successful results, returned while circuit is open
+        self._fallback_cache = LRUCache(maxsize=self.FALLBACK_CACHE_SIZE)
+        self._hedge_executor = None
+        self._hedge_executor_lock = threading.Lock()
 
-    def _api_call(self, api_name: str, api_params: t.Dict = None):
+    def _api_call(self, api_name: str, api_params: t.Dict = None, deadline: Deadline = None):
         """
         Call any API-function of Tilda.
         Вызов любой API-функции Тильды
         :param api_name: string - name of API function
         :param api_params: Dict - GET-parameters. Example: {'projectid': 11111}
+        :param deadline: Deadline - time budget, request timeout is cut to the remaining time
         :return: Dict or List - result of request to Tilda API
         """
         # check api name
         if api_name not in self.TILDA_API_NAMES:
             raise ValueError('Wrong API function name')
 
-        # make api url
-        param_str = '' if not api_params else '&' + urlencode(api_params)
-        url = '{domen}{api_name}/?publickey={public_key}&secretkey={secret_key}{params}'.format(
-            domen=self.TILDA_API_DOMEN,
-            api_name=api_name,
-            public_key=self.TILDA_PUBLICKEY,
-            secret_key=self.TILDA_SECRETKEY,
-            params=param_str
-        )
-
-        with urlopen(url=url, timeout=self.TIMEOUT) as resp:
-            result = json.loads(resp.read())
-
-        # handling data
-        status = result.get('status')
-        if status == 'FOUND':
-            return result['result']
-        elif status == 'ERROR':
-            raise TildaException(result['message'])
+        with self._span('api_call', api_name=api_name, params=api_params):
+            # make api url
+            param_str = '' if not api_params else '&' + urlencode(api_params)
+            url = '{domen}{api_name}/?publickey={public_key}&secretkey={secret_key}{params}'.format(
+                domen=self.TILDA_API_DOMEN,
+                api_name=api_name,
+                public_key=self.TILDA_PUBLICKEY,
+                secret_key=self.TILDA_SECRETKEY,
+                params=param_str
+            )
+
+            timeout = self.TIMEOUT if deadline is None else deadline.timeout(self.TIMEOUT)
+            cache_key = (api_name, param_str)
+            breaker = self._circuit_breakers[api_name] if self.circuit_breaker else None
+            token = None if breaker is None else breaker.allow_request()
+            if breaker is not None and token is None:
+                cached = self._fallback_cache.get(cache_key)
+                if cached is not None:
+                    return cached
+                raise TildaCircuitOpenException('Circuit is open for {}'.format(api_name))
+
+            try:
+                # the trial request of a half open circuit is not doubled
+                if self.hedge_requests and (breaker is None or breaker.state == breaker.CLOSED):
+                    result = self._hedged_request(api_name, url, timeout, deadline)
+                else:
+                    result = self._request(api_name, url, timeout, deadline)
+            except Exception as exc:
+                if breaker is not None:
+                    # network errors, timeouts and broken responses;
+                    # timeout cut by our own deadline is not a failure of the endpoint
+                    if isinstance(exc, (OSError, ValueError, HTTPException)) and \
+                            not (deadline is not None and deadline.expired):
+                        breaker.record_failure(token)
+                    else:
+                        # the error says nothing about the endpoint, but the trial slot must be freed
+                        breaker.record_cancelled(token)
+                raise
+            if breaker is not None:
+                breaker.record_success(token)
+
+            # handling data
+            status = result.get('status')
+            if status == 'FOUND':
+                if breaker is not None:
+                    self._fallback_cache.set(cache_key, result['result'])
+                return result['result']
+            elif status == 'ERROR':
+                raise TildaException(result['message'])
+            else:
+                raise TildaException('Unknown error')
+
+    def _request(self, api_name: str, url: str, timeout: float, deadline: Deadline = None) -> t.Dict:
+        """
+        Send one request to Tilda API and decode json answer.
+        With scheduler the request waits for its turn by priority set by scheduler.priority(),
+        the queued request is cancelled when the deadline passes.
+        Отправка одного запроса к API Тильды и разбор json-ответа.
+        С планировщиком запрос ждет своей очереди согласно приоритету из scheduler.priority(),
+        по истечении времени запрос из очереди отменяется
+        """
+        if self.scheduler is None:
+            return self._send(api_name, url, timeout, deadline)
+        try:
+            return self.scheduler.run(self._send, api_name, url, timeout, deadline,
+                                      timeout=None if deadline is None else deadline.remaining())
+        except FutureTimeoutError:
+            # the same class is raised by the timeout of the request itself (socket.timeout),
+            # it is a failure of the endpoint unless our deadline has passed
+            if deadline is None or not deadline.expired:
+                raise
+            raise TildaDeadlineExceeded('Deadline exceeded')
+
+    def _send(self, api_name: str, url: str, timeout: float, deadline: Deadline = None) -> t.Dict:
+        if deadline is not None:
+            # time spent in the queue is taken from the budget too
+            timeout = deadline.timeout(timeout)
+        start = time.monotonic()
+        if self.tracer is None:
+            with urlopen(url=url, timeout=timeout) as resp:
+                result = json.loads(resp.read())
         else:
-            raise TildaException('Unknown error')
+            body = traced_get(self.tracer, url, timeout)
+            with self.tracer.span('json.loads'):
+                result = json.loads(body)
+        self._latencies[api_name].add(time.monotonic() - start)
+        return result
+
+    def _span(self, name: str, **attributes):
+        """
+        Span of the tracer or empty context if tracing is off.
+        Спан трассировки или пустой контекст, если трассировка выключена
+        """
+        if self.tracer is None:
+            return contextlib.nullcontext()
+        return self.tracer.span(name, **attributes)
+
+    @staticmethod
+    def _submit(executor: ThreadPoolExecutor, fn: t.Callable, *args) -> Future:
+        # run in a copy of the current context, so spans in worker threads get their parent
+        return executor.submit(contextvars.copy_context().run, fn, *args)
+
+    def _hedged_request(self, api_name: str, url: str, timeout: float, deadline: Deadline = None) -> t.Dict:
+        """
+        Send request, and if there is no answer after p95 latency of the endpoint send the same request again.
+        The first successful answer is returned.
+        Отправка запроса; если ответа нет дольше p95 задержки, отправляется такой же запрос.
+        Возвращается первый успешный ответ
+        """
+        delay = self._latencies[api_name].percentile(self.HEDGE_PERCENTILE)
+        delay = self.HEDGE_DEFAULT_DELAY if delay is None else max(delay, self.HEDGE_MIN_DELAY)
+        delay = min(delay, timeout)
+        executor = self._get_hedge_executor()
+
+        futures = [self._submit(executor, self._request, api_name, url, timeout, deadline)]
+        done, _ = wait(futures, timeout=delay, return_when=FIRST_COMPLETED)
+        if not done:
+            futures.append(self._submit(executor, self._request, api_name, url, timeout, deadline))
+
+        error = None
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as exc:
+                error = exc
+                continue
+            for other in futures:
+                other.cancel()
+            return result
+        raise error
+
+    def _get_hedge_executor(self) -> ThreadPoolExecutor:
+        with self._hedge_executor_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(thread_name_prefix='tilda-hedge')
+            return self._hedge_executor
 
-    def get_projects_list(self) -> t.List:
+    def get_projects_list(self, deadline: Deadline = None) -> t.List:
         """
         Return list of Tilda account projects.
         Возвращает список всех проект в аккаунте Тильды
+        :param deadline: Deadline - time budget of the call (optional)
         :return: List
         Example:
            [
@@ -113,14 +271,15 @@ class TildaApi:
                 ...
               ]
         """
-        return self._api_call(self.GET_PROJECTS_LIST)
+        return self._api_call(self.GET_PROJECTS_LIST, deadline=deadline)
 
-    def get_project_info(self, project_id: int) -> t.Dict:
+    def get_project_info(self, project_id: int, deadline: Deadline = None) -> t.Dict:
         """
         Return info of Tilda project
         Возвращает информацию по проекте в Тильде
 
         :param project_id: int, id of tilda project
+        :param deadline: Deadline - time budget of the call (optional)
         :return: Dict
         Example:
             {
@@ -144,13 +303,14 @@ class TildaApi:
                 ]
               }
         """
-        return self._api_call(api_name=self.GET_PROJECT_INFO, api_params={'projectid': project_id})
+        return self._api_call(api_name=self.GET_PROJECT_INFO, api_params={'projectid': project_id}, deadline=deadline)
 
-    def get_pages_list(self, project_id: int) -> t.List:
+    def get_pages_list(self, project_id: int, deadline: Deadline = None) -> t.List:
         """
         Return pages list of tilda project
         Возвращает список страниц в проекте
         :param project_id: int
+        :param deadline: Deadline - time budget of the call (optional)
         :return: List
         Example:
             [
@@ -183,13 +343,14 @@ class TildaApi:
                 ...
               ]
         """
-        return self._api_call(api_name='getpageslist', api_params={'projectid': project_id})
+        return self._api_call(api_name='getpageslist', api_params={'projectid': project_id}, deadline=deadline)
 
-    def get_page(self, page_id: int) -> t.Dict:
+    def get_page(self, page_id: int, deadline: Deadline = None) -> t.Dict:
         """
         Return tilda page info + body-html code of the page
         Возвращает информацию о странице + body html-код
         :param page_id: int
+        :param deadline: Deadline - time budget of the call (optional)
         :return: Dict
         Example:
             {
@@ -213,13 +374,14 @@ class TildaApi:
                 ]
             }
         """
-        return self._api_call(api_name=self.GET_PAGE, api_params={'pageid': page_id})
+        return self._api_call(api_name=self.GET_PAGE, api_params={'pageid': page_id}, deadline=deadline)
 
-    def get_page_full(self, page_id: int) -> t.Dict:
+    def get_page_full(self, page_id: int, deadline: Deadline = None) -> t.Dict:
         """
         Return full tilda page info + full html-code of the page
         Возвращает информацию о странице + полный html-код
         :param page_id: int
+        :param deadline: Deadline - time budget of the call (optional)
         :return: Dict
         Example:
             {
@@ -237,13 +399,14 @@ class TildaApi:
                 "filename": "page1001.html"
             }
         """
-        return self._api_call(api_name=self.GET_PAGE_FULL, api_params={'pageid': page_id})
+        return self._api_call(api_name=self.GET_PAGE_FULL, api_params={'pageid': page_id}, deadline=deadline)
 
-    def get_page_export(self, page_id: int) -> t.Dict:
+    def get_page_export(self, page_id: int, deadline: Deadline = None) -> t.Dict:
         """
         Return tilda page info for export + body-html code of the page
         Возвращает информацию о странице для экспорта + body page html-code
         :param page_id: int
+        :param deadline: Deadline - time budget of the call (optional)
         :return: Dict
         Example:
             {
@@ -275,13 +438,14 @@ class TildaApi:
                 "filename": "page1001.html"
             }
         """
-        return self._api_call(api_name=self.GET_PAGE_EXPORT, api_params={'pageid': page_id})
+        return self._api_call(api_name=self.GET_PAGE_EXPORT, api_params={'pageid': page_id}, deadline=deadline)
 
-    def get_page_full_export(self, page_id: int) -> t.Dict:
+    def get_page_full_export(self, page_id: int, deadline: Deadline = None) -> t.Dict:
         """
         Return full tilda page info + full page html-code
         Возвращает информацию о странице для экспорта + full page html-code
         :param page_id: int
+        :param deadline: Deadline - time budget of the call (optional)
         :return: Dict
         Example:
             {
@@ -313,5 +477,68 @@ class TildaApi:
                 "filename": "page1001.html"
             }
         """
-        return self._api_call(api_name=self.GET_PAGE_FULL_EXPORT, api_params={'pageid': page_id})
+        return self._api_call(api_name=self.GET_PAGE_FULL_EXPORT, api_params={'pageid': page_id}, deadline=deadline)
+
+    def get_pages_bulk(self, page_ids: t.Iterable[int], api_name: str = GET_PAGE_FULL_EXPORT,
+                       deadline: Deadline = None) -> BulkResult:
+        """
+        Fetch many pages in parallel.
+        When the deadline passes, not started requests are cancelled and partial result is returned.
+        Параллельная загрузка нескольких страниц.
+        По истечении времени невыполненные запросы отменяются и возвращается частичный результат
+        :param page_ids: Iterable - ids of pages
+        :param api_name: string - one of getpage, getpagefull, getpageexport, getpagefullexport
+        :param deadline: Deadline - time budget of the whole operation (optional)
+        :return: BulkResult - results by page id, missing page ids and errors
+        """
+        if api_name not in (self.GET_PAGE, self.GET_PAGE_FULL, self.GET_PAGE_EXPORT, self.GET_PAGE_FULL_EXPORT):
+            raise ValueError('Wrong API function name')
+
+        with self._span('get_pages_bulk', api_name=api_name), priority(BULK, override=False):
+            result = BulkResult()
+            executor = ThreadPoolExecutor(max_workers=self.BULK_WORKERS, thread_name_prefix='tilda-bulk')
+            try:
+                futures = {
+                    self._submit(executor, self._api_call, api_name, {'pageid': page_id}, deadline): page_id
+                    for page_id in page_ids
+                }
+                done, not_done = wait(futures, timeout=None if deadline is None else deadline.remaining())
+                for future in futures:
+                    page_id = futures[future]
+                    if future in not_done:
+                        future.cancel()
+                        result.missing.append(page_id)
+                    elif future.exception() is not None:
+                        result.missing.append(page_id)
+                        result.errors[page_id] = future.exception()
+                    else:
+                        result.results[page_id] = future.result()
+            finally:
+                # requests in progress end by themselves: their timeout is cut to the deadline
+                executor.shutdown(wait=False, cancel_futures=True)
+            return result
+
+    def sync_project(self, project_id: int, deadline: Deadline = None) -> SyncResult:
+        """
+        Fetch project info, pages list and full export of every page of the project.
+        Загрузка информации о проекте, списка страниц и полного экспорта каждой страницы проекта
+        :param project_id: int
+        :param deadline: Deadline - time budget of the whole sync (optional)
+        :return: SyncResult - partial if the deadline has passed
+        """
+        with self._span('sync_project', project_id=project_id), priority(BULK, override=False):
+            result = SyncResult(project_id=project_id)
+            try:
+                result.project = self.get_project_info(project_id, deadline=deadline)
+                result.pages_list = self.get_pages_list(project_id, deadline=deadline)
+            except Exception as exc:
+                if deadline is None or not deadline.expired:
+                    raise
+                # no time left even for the pages list
+                result.failed_step = self.GET_PROJECT_INFO if result.project is None else self.GET_PAGES_LIST
+                result.failed_step_error = exc
+                return result
 
+            pages = self.get_pages_bulk([page['id'] for page in result.pages_list], deadline=deadline)
+            result.results, result.missing, result.errors = pages.results, pages.missing, pages.errors
+            return result
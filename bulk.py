@@ -0,0 +1,109 @@
+"""
+Time budgets and partial results of bulk operations with Tilda API.
+
+Бюджеты времени и частичные результаты массовых операций с API Тильды.
+
+Usage/Использование:
+
+tilda_api = TildaApi()
+result = tilda_api.sync_project(project_id=1, deadline=Deadline(60))
+if not result.complete:
+    # result.missing - pages which were not fetched in 60 seconds
+"""
+import time
+import typing as t
+
+from dataclasses import dataclass, field
+
+from exceptions import TildaDeadlineExceeded
+
+
+class Deadline:
+    """
+    Total time budget shared by all requests of an operation.
+    Общий бюджет времени для всех запросов операции
+    """
+
+    def __init__(self, seconds: t.Optional[float], clock: t.Callable[[], float] = time.monotonic):
+        """
+        :param seconds: float - time budget from now, None - no time limit, the deadline may only be cancelled
+        :param clock: callable - source of time, replaced in tests
+        """
+        self._clock = clock
+        self.expires_at = None if seconds is None else clock() + seconds
+
+    def remaining(self) -> t.Optional[float]:
+        """
+        Return seconds left, 0 if the deadline has passed, None if there is no time limit.
+        Возвращает, сколько секунд осталось, None - если время не ограничено
+        """
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - self._clock())
+
+    @property
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def cancel(self):
+        """
+        Expire the deadline at once: requests of the operation which are not started yet are not sent.
+        Досрочно завершить срок: еще не начатые запросы операции не отправляются
+        """
+        self.expires_at = self._clock()
+
+    def timeout(self, default: float) -> float:
+        """
+        Cut request timeout to the remaining budget.
+        Ограничивает таймаут запроса оставшимся временем
+        :param default: float - timeout of request without deadline
+        :return: float
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        if remaining <= 0:
+            raise TildaDeadlineExceeded('Deadline exceeded')
+        return min(default, remaining)
+
+
+@dataclass
+class BulkResult:
+    """
+    Result of bulk operation.
+    Результат массовой операции
+
+    results - fetched data by id
+    missing - ids which were not fetched: failed, cancelled or not started before the deadline
+    errors - exceptions of failed ids
+    """
+    results: t.Dict = field(default_factory=dict)
+    missing: t.List = field(default_factory=list)
+    errors: t.Dict = field(default_factory=dict)
+
+    @property
+    def complete(self) -> bool:
+        return not self.missing
+
+
+@dataclass
+class SyncResult(BulkResult):
+    """
+    Result of project sync: project info, pages list and full export of every page (in results).
+    Результат синхронизации проекта: информация о проекте, список страниц и экспорт каждой страницы (в results)
+
+    results, missing and errors are keyed by page ids.
+    failed_step - API function (getprojectinfo or getpageslist) cut by the deadline before pages were fetched,
+    then the pages are unknown and missing is empty
+    failed_step_error - exception of failed_step
+    """
+    project_id: t.Optional[int] = None
+    project: t.Optional[t.Dict] = None
+    pages_list: t.Optional[t.List] = None
+    failed_step: t.Optional[str] = None
+    failed_step_error: t.Optional[Exception] = None
+
+    @property
+    def complete(self) -> bool:
+        return self.failed_step is None and not self.missing
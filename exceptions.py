@@ -1,3 +1,10 @@
-
 class TildaException(Exception):
     pass
+
+
+class TildaCircuitOpenException(TildaException):
+    pass
+
+
+class TildaDeadlineExceeded(TildaException):
+    pass
@@ -0,0 +1,177 @@
+"""
+Streaming export of Tilda pages and their files to ZIP or TAR archive.
+
+Потоковый экспорт страниц Тильды и их файлов в ZIP или TAR архив.
+
+Pages are exported one by one, files are copied from the network to the archive by chunks,
+so memory use does not depend on the size of the site.
+Страницы экспортируются по одной, файлы копируются из сети в архив частями,
+поэтому расход памяти не зависит от размера сайта.
+
+Usage/Использование:
+
+with ArchiveExporter(TildaApi(), 'site.zip', compresslevel=6) as exporter:
+    exporter.export_project(project_id=1)
+"""
+import gzip
+import io
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import time
+import typing as t
+import zipfile
+
+from urllib.request import urlopen
+
+from bulk import Deadline
+from scheduler import BULK, priority
+
+
+class _ZipWriter:
+    # zip entries are written by chunks without knowing the size in advance
+    needs_size = False
+
+    def __init__(self, fileobj: t.BinaryIO, compresslevel: t.Optional[int]):
+        compression = zipfile.ZIP_STORED if compresslevel is None else zipfile.ZIP_DEFLATED
+        self._zip = zipfile.ZipFile(fileobj, 'w', compression=compression, compresslevel=compresslevel)
+
+    def add(self, name: str, stream: t.BinaryIO, size: t.Optional[int], chunk_size: int):
+        with self._zip.open(name, 'w', force_zip64=size is None or size > zipfile.ZIP64_LIMIT) as dst:
+            shutil.copyfileobj(stream, dst, chunk_size)
+
+    def close(self):
+        self._zip.close()
+
+
+class _TarWriter:
+    # tar header contains the size of the entry
+    needs_size = True
+
+    def __init__(self, fileobj: t.BinaryIO, compresslevel: t.Optional[int]):
+        self._gzip = None
+        if compresslevel is not None:
+            fileobj = self._gzip = gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=compresslevel)
+        # stream mode: archive is never read back or seeked
+        self._tar = tarfile.open(fileobj=fileobj, mode='w|')
+
+    def add(self, name: str, stream: t.BinaryIO, size: int, chunk_size: int):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        self._tar.copybufsize = chunk_size
+        self._tar.addfile(info, stream)
+
+    def close(self):
+        self._tar.close()
+        if self._gzip is not None:
+            self._gzip.close()
+
+
+class ArchiveExporter:
+    """
+    Export pages of Tilda project to archive.
+    Экспорт страниц проекта Тильды в архив
+    """
+
+    CHUNK_SIZE = 64 * 1024
+    # files without Content-Length are kept in memory up to this size, then in temporary file
+    SPOOL_SIZE = 1024 * 1024
+    # keys of getpagefullexport and getprojectinfo answers with files, and fields of project export paths
+    FILE_KEYS = {
+        'images': 'export_imgpath',
+        'css': 'export_csspath',
+        'js': 'export_jspath',
+    }
+
+    def __init__(self, tilda_api, target: t.Union[str, t.BinaryIO], archive_format: str = 'zip',
+                 compresslevel: t.Optional[int] = None):
+        """
+        :param tilda_api: TildaApi
+        :param target: string or file object - path to archive or writable binary stream
+        :param archive_format: string - 'zip' or 'tar'
+        :param compresslevel: int - compression level (zip - deflate 0-9, tar - gzip 0-9), None - no compression
+        """
+        if archive_format not in ('zip', 'tar'):
+            raise ValueError('Wrong archive format')
+        self.tilda_api = tilda_api
+        self._own_file = isinstance(target, str)
+        self._fileobj = open(target, 'wb') if self._own_file else target
+        writer_class = _ZipWriter if archive_format == 'zip' else _TarWriter
+        self._writer = writer_class(self._fileobj, compresslevel)
+        self._paths = {}
+        # names already written to the archive, files shared by pages are downloaded once
+        self._names = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._writer.close()
+        if self._own_file:
+            self._fileobj.close()
+
+    def export_project(self, project_id: int, deadline: Deadline = None) -> t.List[str]:
+        """
+        Export all pages of the project with their files.
+        Экспорт всех страниц проекта вместе с файлами
+        :param project_id: int
+        :param deadline: Deadline - time budget of the export (optional)
+        :return: List - names of written archive entries
+        """
+        with priority(BULK, override=False):
+            project = self.tilda_api.get_project_info(project_id, deadline=deadline)
+            self._paths = {key: (project.get(field) or '').strip('/') for key, field in self.FILE_KEYS.items()}
+            written = self._export_files(project, deadline)
+            for page in self.tilda_api.get_pages_list(project_id, deadline=deadline):
+                written += self.export_page(page['id'], deadline=deadline)
+        return written
+
+    def export_page(self, page_id: int, deadline: Deadline = None) -> t.List[str]:
+        """
+        Export one page with its files.
+        Экспорт одной страницы вместе с файлами
+        :param page_id: int
+        :param deadline: Deadline - time budget of the export (optional)
+        :return: List - names of written archive entries
+        """
+        page = self.tilda_api.get_page_full_export(page_id, deadline=deadline)
+        html = page['html'].encode()
+        written = self._add(page['filename'], io.BytesIO(html), len(html))
+        # the page is not needed anymore, only the list of its files
+        files = {key: page.get(key) or [] for key in self.FILE_KEYS}
+        del page, html
+        return written + self._export_files(files, deadline)
+
+    def _export_files(self, data: t.Dict, deadline: t.Optional[Deadline]) -> t.List[str]:
+        written = []
+        for key in self.FILE_KEYS:
+            for file in data.get(key) or []:
+                if not file.get('from') or not file.get('to'):
+                    continue
+                name = posixpath.join(self._paths.get(key, ''), posixpath.basename(file['to']))
+                if name in self._names:
+                    continue
+                timeout = self.tilda_api.TIMEOUT if deadline is None else deadline.timeout(self.tilda_api.TIMEOUT)
+                with urlopen(url=file['from'], timeout=timeout) as resp:
+                    length = resp.headers.get('Content-Length')
+                    written += self._add(name, resp, int(length) if length else None)
+        return written
+
+    def _add(self, name: str, stream: t.BinaryIO, size: t.Optional[int]) -> t.List[str]:
+        if name in self._names:
+            return []
+        self._names.add(name)
+        if size is None and self._writer.needs_size:
+            with tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE) as spool:
+                shutil.copyfileobj(stream, spool, self.CHUNK_SIZE)
+                size = spool.tell()
+                spool.seek(0)
+                self._writer.add(name, spool, size, self.CHUNK_SIZE)
+        else:
+            self._writer.add(name, stream, size, self.CHUNK_SIZE)
+        return [name]
@@ -0,0 +1,260 @@
+"""
+Caching read-through proxy for Tilda API.
+
+Кэширующий прокси для API Тильды.
+
+Internal services call the proxy instead of Tilda with the same urls (keys are not needed),
+the proxy is the only component which calls Tilda API with its own keys.
+Answers are cached: fresh ones are returned at once, stale ones are returned at once and
+refreshed in background, concurrent requests for a missing answer wait for one upstream call.
+
+Внутренние сервисы обращаются к прокси вместо Тильды по тем же адресам (ключи не нужны),
+только прокси обращается к API Тильды со своими ключами.
+Устаревшие ответы отдаются сразу и обновляются в фоне, одновременные запросы
+отсутствующего в кэше ответа ждут один общий запрос к Тильде.
+
+Usage/Использование:
+
+python proxy.py --port 8080
+# then GET http://127.0.0.1:8080/v1/getpageslist/?projectid=1
+"""
+import argparse
+import json
+import threading
+import time
+import typing as t
+
+from collections import OrderedDict
+from http.client import HTTPException
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from api import TildaApi
+from exceptions import TildaException, TildaCircuitOpenException, TildaDeadlineExceeded
+
+
+class _Call:
+    """
+    Upstream call shared by concurrent requests of the same key.
+    Запрос к Тильде, общий для одновременных запросов одного ключа
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class _Entry:
+
+    def __init__(self, value, fetched_at: float):
+        self.value = value
+        self.fetched_at = fetched_at
+
+
+class ReadThroughCache:
+    """
+    Cache with stale-while-revalidate and coalescing of concurrent misses.
+    Кэш с отдачей устаревших данных во время обновления и объединением одновременных промахов
+    """
+
+    HIT = 'HIT'
+    STALE = 'STALE'
+    MISS = 'MISS'
+
+    def __init__(self, fetch: t.Callable[[t.Hashable], t.Any], ttl: float = 60, stale_ttl: float = 600,
+                 max_entries: int = 1024, clock: t.Callable[[], float] = time.monotonic):
+        """
+        :param fetch: callable - load value by key from upstream
+        :param ttl: float - seconds the value is fresh
+        :param stale_ttl: float - seconds after ttl the stale value is still returned while it is refreshed
+        :param max_entries: int - max number of cached values, the oldest ones are evicted first
+        :param clock: callable - source of time, replaced in tests
+        """
+        self._fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        # ordered by fetch time, the oldest entries are at the beginning
+        self._entries = OrderedDict()
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key: t.Hashable) -> t.Tuple[t.Any, str]:
+        """
+        Return value and cache status (HIT, STALE or MISS).
+        Возвращает значение и статус кэша
+        """
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(key)
+            age = None if entry is None else self._clock() - entry.fetched_at
+        if age is not None and age < self.ttl:
+            return entry.value, self.HIT
+        if age is not None and age < self.ttl + self.stale_ttl:
+            self._refresh(key)
+            return entry.value, self.STALE
+        return self._load(key), self.MISS
+
+    def _load(self, key: t.Hashable):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if leader:
+            self._run(key, call)
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.value
+
+    def _refresh(self, key: t.Hashable):
+        with self._lock:
+            if key in self._calls:
+                # already refreshing
+                return
+            call = self._calls[key] = _Call()
+        threading.Thread(target=self._run, args=(key, call), daemon=True).start()
+
+    def _run(self, key: t.Hashable, call: _Call):
+        try:
+            call.value = self._fetch(key)
+        except Exception as exc:
+            call.error = exc
+        with self._lock:
+            if call.error is None:
+                self._entries[key] = _Entry(call.value, self._clock())
+                self._entries.move_to_end(key)
+                self._evict()
+            del self._calls[key]
+        call.done.set()
+
+    def _evict(self):
+        # must be called with the lock held
+        expired_at = self._clock() - self.ttl - self.stale_ttl
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.fetched_at > expired_at and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[key]
+
+
+class TildaProxyServer:
+    """
+    HTTP server with the same API functions as Tilda API, answers are served from ReadThroughCache.
+    HTTP-сервер с теми же API-функциями, что у Тильды, ответы отдаются из ReadThroughCache
+    """
+
+    # GET-parameters passed to Tilda, keys of clients are ignored
+    PARAMS = ('projectid', 'pageid')
+
+    def __init__(self, tilda_api: TildaApi, host: str = '127.0.0.1', port: int = 0, ttl: float = 60,
+                 stale_ttl: float = 600, max_entries: int = 1024, clock: t.Callable[[], float] = time.monotonic):
+        """
+        :param tilda_api: TildaApi - the only client of Tilda API
+        :param host: string
+        :param port: int - 0 for any free port
+        :param ttl: float - seconds the answer is fresh
+        :param stale_ttl: float - seconds after ttl the stale answer is returned while it is refreshed
+        :param max_entries: int - max number of cached answers
+        """
+        self.tilda_api = tilda_api
+        self.cache = ReadThroughCache(self._fetch, ttl=ttl, stale_ttl=stale_ttl, max_entries=max_entries,
+                                      clock=clock)
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/v1/'.format(host, port)
+
+    def _fetch(self, key: t.Tuple):
+        api_name, params = key
+        return self.tilda_api._api_call(api_name, dict(params) or None)
+
+    def handle(self, path: str) -> t.Tuple[int, t.Dict, str]:
+        """
+        Answer request by its path.
+        Ответ на запрос по его пути
+        :param path: string - path with GET-parameters. Example: /v1/getpage/?pageid=1001
+        :return: Tuple - http status, answer in Tilda format, cache status
+        """
+        parsed = urlparse(path)
+        api_name = parsed.path.strip('/').split('/')[-1]
+        if api_name not in self.tilda_api.TILDA_API_NAMES:
+            return 404, {'status': 'ERROR', 'message': 'Wrong API function name'}, ''
+        query = parse_qs(parsed.query)
+        params = tuple(sorted((name, query[name][0]) for name in self.PARAMS if name in query))
+        try:
+            result, cache_status = self.cache.get((api_name, params))
+        # Tilda is down or slow: not an answer of Tilda, so not 200 with ERROR status
+        except TildaCircuitOpenException as exc:
+            return 503, {'status': 'ERROR', 'message': 'Tilda API is unavailable: {}'.format(exc)}, self.cache.MISS
+        except TildaDeadlineExceeded as exc:
+            return 504, {'status': 'ERROR', 'message': 'Tilda API timed out: {}'.format(exc)}, self.cache.MISS
+        except TildaException as exc:
+            return 200, {'status': 'ERROR', 'message': str(exc)}, self.cache.MISS
+        except (OSError, ValueError, HTTPException) as exc:
+            return 502, {'status': 'ERROR', 'message': 'Tilda API is unavailable: {}'.format(exc)}, self.cache.MISS
+        return 200, {'status': 'FOUND', 'result': result}, cache_status
+
+    def _make_handler(self):
+        proxy = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                status, answer, cache_status = proxy.handle(self.path)
+                data = json.dumps(answer).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                if cache_status:
+                    self.send_header('X-Cache', cache_status)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        """
+        Serve in background thread.
+        Запуск сервера в фоновом потоке
+        """
+        self._thread = threading.Thread(target=self.server.serve_forever, args=(0.1,), daemon=True)
+        self._thread.start()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread.join()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Caching proxy for Tilda API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--ttl', type=float, default=60, help='seconds the answer is fresh')
+    parser.add_argument('--stale-ttl', type=float, default=600,
+                        help='seconds after ttl the stale answer is returned while it is refreshed')
+    parser.add_argument('--max-entries', type=int, default=1024, help='max number of cached answers')
+    args = parser.parse_args()
+    proxy_server = TildaProxyServer(TildaApi(), host=args.host, port=args.port, ttl=args.ttl,
+                                    stale_ttl=args.stale_ttl, max_entries=args.max_entries)
+    proxy_server.serve_forever()
@@ -0,0 +1,186 @@
+"""
+Helpers for keeping Tilda API calls fast and safe when the API is slow or degraded.
+
+Вспомогательные классы для вызовов API Тильды, когда API тормозит или недоступен.
+
+LatencyTracker - rolling latency window of one endpoint, used to pick the delay of hedged requests.
+CircuitBreaker - per-endpoint circuit breaker, fails fast while the endpoint keeps failing.
+LRUCache - thread safe cache of limited size, keeps results returned while the circuit is open.
+"""
+import itertools
+import math
+import threading
+import time
+import typing as t
+
+from collections import deque, OrderedDict
+
+
+class LatencyTracker:
+    """
+    Keep the latest latencies of one API endpoint and compute percentiles over them.
+    Хранит последние задержки одной API-функции и считает по ним перцентили.
+    """
+
+    def __init__(self, window: int = 100, min_samples: int = 20):
+        """
+        :param window: int - how many latest latencies are kept
+        :param min_samples: int - percentile is not trusted until this number of samples is collected
+        """
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, latency: float):
+        """
+        Add latency of a successful request (seconds).
+        Добавить задержку успешного запроса (в секундах)
+        """
+        with self._lock:
+            self._samples.append(latency)
+
+    def percentile(self, percent: float) -> t.Optional[float]:
+        """
+        Return percentile of collected latencies or None if there are too few of them.
+        Возвращает перцентиль задержек или None, если данных пока мало
+        :param percent: float - from 0 to 100
+        :return: float or None
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return None
+        index = max(0, math.ceil(percent / 100 * len(samples)) - 1)
+        return samples[index]
+
+
+class LRUCache:
+    """
+    Thread safe cache of limited size, least recently used values are evicted first.
+    Потокобезопасный кэш ограниченного размера, первыми вытесняются давно не использованные значения
+    """
+
+    def __init__(self, maxsize: int = 128):
+        """
+        :param maxsize: int - max number of values
+        """
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: t.Hashable, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: t.Hashable, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key: t.Hashable) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for one API endpoint.
+    Предохранитель для одной API-функции.
+
+    CLOSED - requests go through, consecutive failures are counted.
+    OPEN - requests are rejected until recovery_timeout passes.
+    HALF_OPEN - one trial request is let through, its result closes or re-opens the circuit.
+
+    Every allowed request gets a token which is passed back with its outcome,
+    so late outcomes of requests sent before the circuit opened don't change the half open state.
+    Каждый разрешенный запрос получает токен, который передается вместе с результатом запроса,
+    поэтому запоздавшие результаты запросов, отправленных до размыкания, не влияют на пробный запрос.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30,
+                 clock: t.Callable[[], float] = time.monotonic):
+        """
+        :param failure_threshold: int - consecutive failures which open the circuit
+        :param recovery_timeout: float - seconds the circuit stays open before a trial request
+        :param clock: callable - source of time, replaced in tests
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._clock = clock
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._tokens = itertools.count(1)
+        self._trial = None  # token of the trial request in progress
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and self._clock() - self._opened_at >= self.recovery_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow_request(self) -> t.Optional[int]:
+        """
+        Check if a request may be sent now.
+        Проверка, можно ли сейчас отправить запрос
+        :return: int - token of the request for record_*() methods, None if the request must not be sent
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return next(self._tokens)
+            if self._state == self.OPEN:
+                if self._clock() - self._opened_at < self.recovery_timeout:
+                    return None
+                self._state = self.HALF_OPEN
+                self._trial = None
+            # half open: only one trial request at a time
+            if self._trial is not None:
+                return None
+            self._trial = next(self._tokens)
+            return self._trial
+
+    def _is_stale(self, token: int) -> bool:
+        # while the circuit is not closed only the outcome of the trial request counts
+        return self._state != self.CLOSED and token != self._trial
+
+    def record_success(self, token: int):
+        with self._lock:
+            if self._is_stale(token):
+                return
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial = None
+
+    def record_cancelled(self, token: int):
+        """
+        Request ended without telling anything about the endpoint: free the trial slot, count nothing.
+        Запрос завершился, не дав информации о состоянии API-функции: освободить пробный запрос
+        """
+        with self._lock:
+            if token == self._trial:
+                self._trial = None
+
+    def record_failure(self, token: int):
+        with self._lock:
+            if self._is_stale(token):
+                return
+            self._failures += 1
+            self._trial = None
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = self._clock()
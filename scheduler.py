@@ -0,0 +1,273 @@
+"""
+Priority scheduler of Tilda API requests sharing one rate budget.
+
+Планировщик запросов к API Тильды с приоритетами и общим лимитом частоты запросов.
+
+Requests are queued by priority class. Queued interactive requests are always sent first,
+and one worker is kept for them, so they don't wait for bulk requests in progress.
+Other classes share the rate budget by weighted fair queuing, so bulk sync can't starve anything.
+Requests already sent are never interrupted.
+Запросы ставятся в очередь по классам приоритета. Интерактивные запросы из очереди отправляются
+первыми, для них оставляется свободный воркер, поэтому они не ждут выполняющихся массовых запросов.
+Остальные классы делят лимит запросов пропорционально весам. Отправленные запросы не прерываются.
+
+Usage/Использование:
+
+tilda_api = TildaApi(scheduler=RequestScheduler(rate=2))
+with priority(INTERACTIVE):
+    page = tilda_api.get_page(page_id=1001)
+"""
+import contextlib
+import contextvars
+import math
+import threading
+import time
+import typing as t
+
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+INTERACTIVE = 'interactive'
+DEFAULT = 'default'
+BULK = 'bulk'
+
+_current_priority = contextvars.ContextVar('tilda_priority', default=None)
+
+
+@contextlib.contextmanager
+def priority(level: str, override: bool = True):
+    """
+    Set priority class of requests made in the block.
+    Задает класс приоритета запросов внутри блока
+    :param level: string - INTERACTIVE, DEFAULT or BULK
+    :param override: bool - if False, priority set by outer code is kept
+    """
+    if not override and _current_priority.get() is not None:
+        yield
+        return
+    token = _current_priority.set(level)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def current_priority() -> str:
+    return _current_priority.get() or DEFAULT
+
+
+class _Item:
+
+    def __init__(self, tag: float, fn: t.Callable, args: t.Tuple, level: str, enqueued_at: float):
+        self.tag = tag
+        self.fn = fn
+        self.args = args
+        self.level = level
+        self.enqueued_at = enqueued_at
+        self.future = Future()
+
+
+class _ClassStats:
+
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.max_depth = 0
+        self.waits = deque(maxlen=1000)
+
+
+class RequestScheduler:
+    """
+    Queue of requests with priority classes, weighted fair queuing and rate limit.
+    Очередь запросов с классами приоритета, взвешенным справедливым обслуживанием и лимитом частоты
+    """
+
+    # share of the rate budget of classes which are not preemptive
+    WEIGHTS = {DEFAULT: 4, BULK: 1}
+    # queued requests of these classes are sent before queued requests of other classes (strict priority)
+    PREEMPTIVE = (INTERACTIVE,)
+
+    def __init__(self, workers: int = 4, rate: float = None, burst: int = 1, weights: t.Dict[str, float] = None,
+                 reserved_workers: int = 1, clock: t.Callable[[], float] = time.monotonic):
+        """
+        :param workers: int - requests sent at the same time
+        :param rate: float - requests per second for all classes, None - no limit
+        :param burst: int - requests which may be sent at once after idle time
+        :param weights: Dict - share of the rate budget of every class which is not preemptive
+        :param reserved_workers: int - workers which only send requests of preemptive classes,
+            at least one worker is left for other classes
+        """
+        self.weights = dict(self.WEIGHTS, **(weights or {}))
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._refilled_at = clock()
+        levels = list(self.PREEMPTIVE) + [level for level in self.weights if level not in self.PREEMPTIVE]
+        self._queues = {level: deque() for level in levels}
+        self._finish_tags = {level: 0.0 for level in self.weights}
+        self._virtual_time = 0.0
+        self._shared_workers = workers - max(0, min(reserved_workers, workers - 1))
+        self._running_shared = 0
+        self._stats = {level: _ClassStats() for level in levels}
+        self._closed = False
+        self._cond = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._work, name='tilda-scheduler-{}'.format(i), daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn: t.Callable, *args, level: str = None) -> Future:
+        """
+        Queue call of fn in the current context.
+        Поставить вызов fn в очередь, вызов выполняется в текущем контексте
+        :param level: string - priority class, by default the one set by priority()
+        :return: Future
+        """
+        level = level or current_priority()
+        if level not in self._queues:
+            raise ValueError('Unknown priority class')
+        context = contextvars.copy_context()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Scheduler is shut down')
+            if level in self.PREEMPTIVE:
+                tag = 0.0
+            else:
+                # weighted fair queuing: virtual finish time of the request in its class
+                tag = max(self._virtual_time, self._finish_tags[level]) + 1 / self.weights[level]
+                self._finish_tags[level] = tag
+            item = _Item(tag, context.run, (fn,) + args, level, self._clock())
+            self._queues[level].append(item)
+            stats = self._stats[level]
+            stats.submitted += 1
+            stats.max_depth = max(stats.max_depth, len(self._queues[level]))
+            self._cond.notify()
+        return item.future
+
+    def run(self, fn: t.Callable, *args, level: str = None, timeout: float = None):
+        """
+        Queue call of fn and wait for its result.
+        If the result is not ready in timeout seconds, the queued call is cancelled and never sent.
+        Поставить вызов в очередь и дождаться результата.
+        Если результата нет за timeout секунд, вызов из очереди отменяется
+        :raise concurrent.futures.TimeoutError: if timeout has passed or fn itself raised TimeoutError
+        """
+        future = self.submit(fn, *args, level=level)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            # TimeoutError (and socket.timeout) raised by fn comes here too, then the future is done
+            if not future.done():
+                future.cancel()
+            raise
+
+    def stats(self) -> t.Dict[str, t.Dict]:
+        """
+        Queue depth and wait time in queue (seconds) of every priority class.
+        Глубина очереди и время ожидания в очереди (в секундах) по классам приоритета
+        """
+        with self._cond:
+            result = {}
+            for level, stats in self._stats.items():
+                waits = sorted(stats.waits)
+                result[level] = {
+                    'queued': len(self._queues[level]),
+                    'max_queued': stats.max_depth,
+                    'submitted': stats.submitted,
+                    'completed': stats.completed,
+                    'cancelled': stats.cancelled,
+                    'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+                    'wait_p95': waits[max(0, math.ceil(0.95 * len(waits)) - 1)] if waits else 0.0,
+                    'wait_max': waits[-1] if waits else 0.0,
+                }
+            return result
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stop workers after the queued requests are sent.
+        Остановить воркеры после отправки запросов из очереди
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _token_delay(self) -> float:
+        # token bucket of the shared rate budget
+        if self.rate is None:
+            return 0.0
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def _next_level(self) -> t.Optional[str]:
+        # the class is chosen when the request is sent, not when it is queued,
+        # so requests of preemptive classes overtake everything already waiting
+        for level in self.PREEMPTIVE:
+            if self._queues[level]:
+                return level
+        if self._running_shared >= self._shared_workers:
+            # the rest of workers are kept for preemptive classes
+            return None
+        queued = [(queue[0].tag, level) for level, queue in self._queues.items() if queue]
+        return min(queued)[1] if queued else None
+
+    def _pop(self, level: str) -> _Item:
+        item = self._queues[level].popleft()
+        if level not in self.PREEMPTIVE:
+            self._virtual_time = max(self._virtual_time, item.tag)
+            self._running_shared += 1
+        return item
+
+    def _drop_cancelled(self):
+        # cancelled calls are removed before a token is taken, so they don't spend the rate budget
+        for level, queue in self._queues.items():
+            while queue and queue[0].future.cancelled():
+                queue.popleft()
+                self._stats[level].cancelled += 1
+
+    def _next(self) -> t.Optional[_Item]:
+        with self._cond:
+            while True:
+                self._drop_cancelled()
+                level = self._next_level()
+                if level is None:
+                    if self._closed and not any(self._queues.values()):
+                        return None
+                    # nothing queued or all shared workers are busy
+                    self._cond.wait()
+                    continue
+                delay = self._token_delay()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                if self.rate is not None:
+                    self._tokens -= 1
+                item = self._pop(level)
+                self._stats[item.level].waits.append(self._clock() - item.enqueued_at)
+                return item
+
+    def _work(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            if item.future.set_running_or_notify_cancel():
+                try:
+                    item.future.set_result(item.fn(*item.args))
+                except BaseException as exc:
+                    item.future.set_exception(exc)
+            with self._cond:
+                self._stats[item.level].completed += 1
+                if item.level not in self.PREEMPTIVE:
+                    self._running_shared -= 1
+                    self._cond.notify_all()
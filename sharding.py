@@ -0,0 +1,248 @@
+"""
+Sharded sync of Tilda projects by several workers without duplicated work.
+
+Синхронизация проектов Тильды несколькими воркерами без повторной работы.
+
+Workers share a SQLite file with leases. A worker syncs a project only while it holds
+the lease of this project and renews the lease while working. Leases of dead workers expire
+and are taken over by others. Each worker goes through projects in its own order
+(rendezvous hashing), so workers rarely compete for the same project.
+For workers on several machines the file must be on storage with working file locks.
+
+Воркеры используют общий SQLite-файл с арендами. Воркер синхронизирует проект, только пока
+владеет арендой проекта, и продлевает ее во время работы. Аренды упавших воркеров истекают
+и переходят к другим воркерам.
+
+Usage/Использование:
+
+store = LeaseStore('leases.sqlite')
+result = ShardedSync(TildaApi(), store, run_id='2020-01-01').run()
+"""
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+import typing as t
+import uuid
+
+from bulk import Deadline, BulkResult
+
+
+class LeaseStore:
+    """
+    Leases of projects in SQLite file.
+    Аренды проектов в SQLite-файле
+    """
+
+    def __init__(self, path: str, lease_ttl: float = 60, clock: t.Callable[[], float] = time.time):
+        """
+        :param path: string - path to SQLite file shared by workers
+        :param lease_ttl: float - seconds the lease is valid without renewal
+        :param clock: callable - source of time, wall clock because workers may run on several machines
+        """
+        self.path = path
+        self.lease_ttl = lease_ttl
+        self._clock = clock
+        self._execute(
+            'CREATE TABLE IF NOT EXISTS leases ('
+            'run_id TEXT NOT NULL, '
+            'project_id TEXT NOT NULL, '
+            'worker_id TEXT NOT NULL, '
+            'expires_at REAL NOT NULL, '
+            'done INTEGER NOT NULL DEFAULT 0, '
+            'PRIMARY KEY (run_id, project_id))',
+            ()
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        # new connection for every operation: the store is used from heartbeat threads too
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _execute(self, query: str, params: t.Tuple) -> int:
+        conn = self._connect()
+        try:
+            return conn.execute(query, params).rowcount
+        finally:
+            conn.close()
+
+    def acquire(self, run_id: str, project_id: str, worker_id: str) -> bool:
+        """
+        Take the lease if the project is free, its lease has expired or it is already ours.
+        Взять аренду, если проект свободен, аренда истекла или уже принадлежит воркеру
+        :return: bool - True if the lease is taken
+        """
+        now = self._clock()
+        return self._execute(
+            'INSERT INTO leases (run_id, project_id, worker_id, expires_at) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (run_id, project_id) DO UPDATE SET '
+            'worker_id = excluded.worker_id, expires_at = excluded.expires_at '
+            'WHERE leases.done = 0 AND (leases.expires_at < ? OR leases.worker_id = excluded.worker_id)',
+            (run_id, str(project_id), worker_id, now + self.lease_ttl, now)
+        ) == 1
+
+    def renew(self, run_id: str, project_id: str, worker_id: str) -> bool:
+        """
+        Extend our lease.
+        Продлить аренду
+        :return: bool - False if the lease was lost
+        """
+        now = self._clock()
+        return self._execute(
+            'UPDATE leases SET expires_at = ? '
+            'WHERE run_id = ? AND project_id = ? AND worker_id = ? AND done = 0 AND expires_at >= ?',
+            (now + self.lease_ttl, run_id, str(project_id), worker_id, now)
+        ) == 1
+
+    def complete(self, run_id: str, project_id: str, worker_id: str) -> bool:
+        """
+        Mark project as synced in this run, nobody will take it again.
+        Отметить проект как синхронизированный в этом запуске
+        :return: bool - False if the lease was lost
+        """
+        return self._execute(
+            'UPDATE leases SET done = 1 WHERE run_id = ? AND project_id = ? AND worker_id = ? AND done = 0',
+            (run_id, str(project_id), worker_id)
+        ) == 1
+
+    def release(self, run_id: str, project_id: str, worker_id: str):
+        """
+        Give up the lease so other workers can take the project at once.
+        Отказаться от аренды, чтобы проект сразу могли взять другие воркеры
+        """
+        self._execute(
+            'DELETE FROM leases WHERE run_id = ? AND project_id = ? AND worker_id = ? AND done = 0',
+            (run_id, str(project_id), worker_id)
+        )
+
+    def done_projects(self, run_id: str) -> t.Set[str]:
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT project_id FROM leases WHERE run_id = ? AND done = 1', (run_id,))
+            return {row[0] for row in rows}
+        finally:
+            conn.close()
+
+
+class _Heartbeat:
+    """
+    Background renewal of one lease, the deadline of the work is cancelled when the lease is lost.
+    Фоновое продление одной аренды, при потере аренды срок работы завершается досрочно
+    """
+
+    def __init__(self, store: LeaseStore, run_id: str, project_id: str, worker_id: str, deadline: Deadline):
+        self.lost = False
+        self._stop = threading.Event()
+        self._args = (run_id, project_id, worker_id)
+        self._store = store
+        self._deadline = deadline
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        interval = self._store.lease_ttl / 3
+        renewed_at = time.monotonic()
+        while not self._stop.wait(interval):
+            try:
+                renewed = self._store.renew(*self._args)
+            except sqlite3.Error:
+                # e.g. database is locked: try again while the lease is still valid
+                if time.monotonic() - renewed_at + interval < self._store.lease_ttl:
+                    continue
+                renewed = False
+            if not renewed:
+                # stop the work before another worker takes the project
+                self.lost = True
+                self._deadline.cancel()
+                return
+            renewed_at = time.monotonic()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class ShardedSync:
+    """
+    One worker of sharded sync.
+    Один воркер распределенной синхронизации
+    """
+
+    POLL_INTERVAL = 5
+
+    def __init__(self, tilda_api, store: LeaseStore, run_id: str, worker_id: str = None,
+                 project_timeout: float = None):
+        """
+        :param tilda_api: TildaApi
+        :param store: LeaseStore - shared by all workers
+        :param run_id: string - id of the sync run, the same for all workers. Example: date of nightly sync
+        :param worker_id: string - unique id of the worker, generated if not passed
+        :param project_timeout: float - time budget of one project sync (optional)
+        """
+        self.tilda_api = tilda_api
+        self.store = store
+        self.run_id = run_id
+        self.worker_id = worker_id or '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.project_timeout = project_timeout
+
+    def _shard_order(self, project_ids: t.List[str]) -> t.List[str]:
+        """
+        Rendezvous hashing: every worker has its own order of projects,
+        so workers start from different projects and meet only at the end.
+        """
+        def score(project_id):
+            key = '{}:{}'.format(self.worker_id, project_id).encode()
+            return hashlib.md5(key).hexdigest()
+        return sorted(project_ids, key=score)
+
+    def run(self) -> BulkResult:
+        """
+        Sync projects of the account until all of them are synced by this or other workers.
+        Синхронизация проектов аккаунта, пока все они не будут синхронизированы этим или другими воркерами
+        :return: BulkResult - SyncResult by project id for projects synced by this worker,
+            missing - projects this worker failed to sync
+        """
+        result = BulkResult()
+        project_ids = [str(project['id']) for project in self.tilda_api.get_projects_list()]
+        pending = self._shard_order(project_ids)
+
+        while pending:
+            done = self.store.done_projects(self.run_id)
+            pending = [project_id for project_id in pending if project_id not in done]
+            waiting = []
+            for project_id in pending:
+                if not self.store.acquire(self.run_id, project_id, self.worker_id):
+                    # leased by another worker: wait, its lease may expire
+                    waiting.append(project_id)
+                    continue
+                self._sync_project(project_id, result)
+            pending = waiting
+            if pending:
+                time.sleep(self.POLL_INTERVAL)
+        return result
+
+    def _sync_project(self, project_id: str, result: BulkResult):
+        # without project_timeout the deadline only stops the sync when the lease is lost
+        deadline = Deadline(self.project_timeout)
+        with _Heartbeat(self.store, self.run_id, project_id, self.worker_id, deadline) as heartbeat:
+            try:
+                sync = self.tilda_api.sync_project(project_id, deadline=deadline)
+            except Exception as exc:
+                sync, error = None, exc
+        if sync is None or not sync.complete:
+            # let other workers try again
+            self.store.release(self.run_id, project_id, self.worker_id)
+            result.missing.append(project_id)
+            if sync is None:
+                result.errors[project_id] = error
+            else:
+                result.results[project_id] = sync
+        elif heartbeat.lost or not self.store.complete(self.run_id, project_id, self.worker_id):
+            # lease expired and the project went to another worker
+            result.missing.append(project_id)
+        else:
+            result.results[project_id] = sync
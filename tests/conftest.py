@@ -0,0 +1,125 @@
+import json
+import threading
+import time
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from api import TildaApi
+
+
+def found(result):
+    # successful answer of Tilda API
+    return {'status': 'FOUND', 'result': result}
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class StubTildaServer:
+    """
+    Local HTTP server imitating Tilda API.
+    Handlers are registered by API function name (or file name) and get (call number, GET-params),
+    they return (http status, answer), (http status, answer, delay in seconds)
+    or (http status, answer, delay in seconds, dict of extra headers).
+    Answer is a dict sent as json, bytes sent as a file or a list of bytes sent as a file without Content-Length.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.calls = []
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                api_name = parsed.path.strip('/').split('/')[-1]
+                params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+                with stub._lock:
+                    stub.calls.append(api_name)
+                    number = stub.calls.count(api_name)
+                handler = stub.handlers.get(api_name)
+                if handler is None:
+                    answer = (404, {'status': 'ERROR', 'message': 'unknown method'})
+                else:
+                    answer = handler(number, params)
+                status, body = answer[0], answer[1]
+                if len(answer) > 2:
+                    time.sleep(answer[2])
+                try:
+                    self.send_response(status)
+                    for name, value in (answer[3] if len(answer) > 3 else {}).items():
+                        self.send_header(name, value)
+                    if isinstance(body, list):
+                        # file sent by chunks without Content-Length
+                        self.send_header('Content-Type', 'application/octet-stream')
+                        self.end_headers()
+                        for chunk in body:
+                            self.wfile.write(chunk)
+                        return
+                    if isinstance(body, bytes):
+                        data, content_type = body, 'application/octet-stream'
+                    else:
+                        data, content_type = json.dumps(body).encode(), 'application/json'
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}/v1/'.format(self.server.server_address[1])
+        self._thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+
+    def count(self, api_name: str) -> int:
+        with self._lock:
+            return self.calls.count(api_name)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def tilda_settings(tmp_path, monkeypatch):
+    # TildaApi reads keys from settings.ini in the working directory
+    (tmp_path / 'settings.ini').write_text('[tilda]\npublickey=publickey\nsecretkey=secretkey\n')
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture
+def stub_server():
+    server = StubTildaServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def stub_api(stub_server):
+    tilda_api = TildaApi()
+    tilda_api.TILDA_API_DOMEN = stub_server.url
+    return tilda_api
+
+
+@pytest.fixture
+def fake_clock():
+    return FakeClock()
@@ -0,0 +1,107 @@
+import time
+from urllib.error import HTTPError
+
+import pytest
+
+from api import TildaApi
+from bulk import Deadline
+from exceptions import TildaDeadlineExceeded
+from tests.conftest import found
+
+
+@pytest.fixture
+def stub_api(stub_api, stub_server):
+    stub_server.handlers['getprojectinfo'] = lambda number, params: (200, found({'id': params['projectid']}))
+    stub_server.handlers['getpageslist'] = lambda number, params: (
+        200, found([{'id': str(page_id), 'projectid': params['projectid']} for page_id in (1001, 1002, 1003)])
+    )
+    return stub_api
+
+
+def test_deadline(fake_clock):
+    deadline = Deadline(10, clock=fake_clock)
+    assert deadline.timeout(5) == 5
+    fake_clock.now = 8
+    assert deadline.remaining() == 2
+    assert deadline.timeout(5) == 2
+    fake_clock.now = 10
+    assert deadline.expired
+    with pytest.raises(TildaDeadlineExceeded):
+        deadline.timeout(5)
+
+    deadline = Deadline(None, clock=fake_clock)
+    assert deadline.remaining() is None
+    assert deadline.timeout(5) == 5
+    deadline.cancel()
+    assert deadline.expired
+
+
+def test_api_call_with_expired_deadline(stub_server, stub_api, fake_clock):
+    with pytest.raises(TildaDeadlineExceeded):
+        stub_api.get_page(page_id=1001, deadline=Deadline(0, clock=fake_clock))
+    assert stub_server.count('getpage') == 0
+
+
+def test_sync_project_complete(stub_server, stub_api):
+    stub_server.handlers['getpagefullexport'] = lambda number, params: (200, found({'id': params['pageid']}))
+
+    result = stub_api.sync_project(project_id=1, deadline=Deadline(5))
+    assert result.complete
+    assert result.project == {'id': '1'}
+    assert result.results == {'1001': {'id': '1001'}, '1002': {'id': '1002'}, '1003': {'id': '1003'}}
+
+
+def test_sync_project_partial_on_deadline(stub_server, stub_api):
+    stub_server.handlers['getpagefullexport'] = lambda number, params: (
+        200, found({'id': params['pageid']}), 2 if params['pageid'] == '1002' else 0
+    )
+
+    start = time.monotonic()
+    result = stub_api.sync_project(project_id=1, deadline=Deadline(0.5))
+    assert time.monotonic() - start < 1.5
+    assert not result.complete
+    assert result.missing == ['1002']
+    assert set(result.results) == {'1001', '1003'}
+
+
+def test_sync_project_cut_before_pages_list(stub_server, stub_api):
+    stub_server.handlers['getpageslist'] = lambda number, params: (200, found([]), 1)
+
+    result = stub_api.sync_project(project_id=1, deadline=Deadline(0.3))
+    assert not result.complete
+    assert result.failed_step == TildaApi.GET_PAGES_LIST
+    assert result.failed_step_error is not None
+    assert result.project == {'id': '1'}
+    # missing and errors hold page ids only
+    assert result.missing == [] and result.errors == {}
+
+
+def test_bulk_cancels_not_started_requests(stub_server, stub_api):
+    stub_server.handlers['getpage'] = lambda number, params: (200, found({'id': params['pageid']}), 1)
+    stub_api.BULK_WORKERS = 1
+
+    result = stub_api.get_pages_bulk(range(5), api_name=TildaApi.GET_PAGE, deadline=Deadline(0.3))
+    assert result.missing == [0, 1, 2, 3, 4]
+    # only the first request was started, the rest were cancelled
+    assert stub_server.count('getpage') == 1
+
+
+def test_bulk_wrong_api_name(stub_api):
+    with pytest.raises(ValueError):
+        stub_api.get_pages_bulk([1], api_name=TildaApi.GET_PROJECTS_LIST)
+
+
+def test_deadline_during_circuit_breaker_trial(stub_server, stub_api):
+    stub_server.handlers['getpage'] = lambda number, params: (
+        (500, {}) if number == 1 else (200, found({'id': params['pageid']}), 0.5 if number == 2 else 0)
+    )
+    stub_api.circuit_breaker = True
+    stub_api.CIRCUIT_FAILURE_THRESHOLD = 1
+    stub_api.CIRCUIT_RECOVERY_TIMEOUT = 0
+    with pytest.raises(HTTPError):
+        stub_api.get_page(page_id=1001)
+
+    # the trial request is cut by our deadline, the breaker lets the next trial through
+    with pytest.raises(OSError):
+        stub_api.get_page(page_id=1001, deadline=Deadline(0.1))
+    assert stub_api.get_page(page_id=1001) == {'id': '1001'}
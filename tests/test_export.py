@@ -0,0 +1,98 @@
+import gzip
+import io
+import tarfile
+import tracemalloc
+import zipfile
+
+import pytest
+
+from export import ArchiveExporter
+from tests.conftest import found
+
+BIG_FILE_SIZE = 8 * 1024 * 1024
+
+
+@pytest.fixture
+def stub_api(stub_api, stub_server):
+    files_url = stub_server.url + 'files/'
+    stub_server.handlers['getprojectinfo'] = lambda number, params: (200, found({
+        'id': params['projectid'],
+        'export_imgpath': '/img',
+        'export_csspath': 'css',
+        'export_jspath': '',
+        'images': [{'from': files_url + 'favicon.ico', 'to': 'favicon.ico'}],
+    }))
+    stub_server.handlers['getpageslist'] = lambda number, params: (200, found([{'id': '1001'}, {'id': '1002'}]))
+    stub_server.handlers['getpagefullexport'] = lambda number, params: (200, found({
+        'id': params['pageid'],
+        'html': '<html>{}</html>'.format(params['pageid']),
+        'filename': 'page{}.html'.format(params['pageid']),
+        'images': [{'from': files_url + 'logo.png', 'to': 'logo.png'}],
+        'css': [{'from': files_url + 'style.css', 'to': 'style.css'}],
+    }))
+    stub_server.handlers['favicon.ico'] = lambda number, params: (200, b'icon')
+    stub_server.handlers['logo.png'] = lambda number, params: (200, b'png' * 1000)
+    # sent without Content-Length
+    stub_server.handlers['style.css'] = lambda number, params: (200, [b'body {}', b' p {}'])
+    return stub_api
+
+
+EXPECTED_FILES = {
+    'img/favicon.ico': b'icon',
+    'page1001.html': b'<html>1001</html>',
+    'img/logo.png': b'png' * 1000,
+    'css/style.css': b'body {} p {}',
+    'page1002.html': b'<html>1002</html>',
+}
+
+
+def test_export_project_to_zip(stub_server, stub_api):
+    archive = io.BytesIO()
+    with ArchiveExporter(stub_api, archive, compresslevel=9) as exporter:
+        written = exporter.export_project(project_id=1)
+    assert written == list(EXPECTED_FILES)
+    # files shared by pages are downloaded once
+    assert stub_server.count('logo.png') == 1
+
+    with zipfile.ZipFile(archive) as result:
+        assert {name: result.read(name) for name in result.namelist()} == EXPECTED_FILES
+        assert result.getinfo('img/logo.png').compress_type == zipfile.ZIP_DEFLATED
+
+
+@pytest.mark.parametrize('compresslevel', [None, 1])
+def test_export_project_to_tar(stub_api, compresslevel):
+    archive = io.BytesIO()
+    with ArchiveExporter(stub_api, archive, archive_format='tar', compresslevel=compresslevel) as exporter:
+        exporter.export_project(project_id=1)
+
+    data = archive.getvalue()
+    if compresslevel is not None:
+        data = gzip.decompress(data)
+    with tarfile.open(fileobj=io.BytesIO(data)) as result:
+        assert {member.name: result.extractfile(member).read() for member in result} == EXPECTED_FILES
+
+
+def test_wrong_archive_format(stub_api):
+    with pytest.raises(ValueError):
+        ArchiveExporter(stub_api, io.BytesIO(), archive_format='rar')
+
+
+@pytest.mark.parametrize('archive_format', ['zip', 'tar'])
+def test_export_memory_does_not_depend_on_file_size(tmp_path, stub_server, stub_api, archive_format):
+    chunk = b'x' * 64 * 1024
+    files_url = stub_server.url + 'files/'
+    stub_server.handlers['getpagefullexport'] = lambda number, params: (200, found({
+        'html': '', 'filename': 'page.html', 'images': [{'from': files_url + 'big.png', 'to': 'big.png'}],
+    }))
+    # big file without Content-Length
+    stub_server.handlers['big.png'] = lambda number, params: (200, [chunk] * (BIG_FILE_SIZE // len(chunk)))
+
+    tracemalloc.start()
+    try:
+        with ArchiveExporter(stub_api, str(tmp_path / 'site'), archive_format=archive_format) as exporter:
+            exporter.export_page(page_id=1)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < BIG_FILE_SIZE / 4
+    assert (tmp_path / 'site').stat().st_size > BIG_FILE_SIZE
@@ -0,0 +1,160 @@
+import json
+import threading
+import time
+from http.client import IncompleteRead
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+
+from exceptions import TildaException, TildaDeadlineExceeded
+from proxy import ReadThroughCache, TildaProxyServer
+from tests.conftest import found
+
+
+@pytest.fixture
+def proxy_server(stub_server, stub_api, fake_clock):
+    stub_server.handlers['getpageslist'] = lambda number, params: (
+        200, found([{'id': '1001', 'projectid': params['projectid'], 'version': number}])
+    )
+    server = TildaProxyServer(stub_api, ttl=10, stale_ttl=100, clock=fake_clock)
+    server.start()
+    yield server
+    server.shutdown()
+
+
+def get(url):
+    with urlopen(url, timeout=5) as resp:
+        return json.loads(resp.read()), resp.headers['X-Cache']
+
+
+def wait_for(condition):
+    for _ in range(100):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError('condition is not met')
+
+
+def test_cache_coalesces_concurrent_misses():
+    calls = []
+
+    def fetch(key):
+        calls.append(key)
+        time.sleep(0.2)
+        return key * 2
+
+    cache = ReadThroughCache(fetch)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(21))) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == [21]
+    assert [value for value, _ in results] == [42] * 10
+    assert cache.get(21) == (42, ReadThroughCache.HIT)
+
+
+def test_cache_errors_are_not_cached():
+    answers = [TildaException('error'), 'value']
+
+    def fetch(key):
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    cache = ReadThroughCache(fetch)
+    with pytest.raises(TildaException):
+        cache.get('key')
+    assert cache.get('key') == ('value', ReadThroughCache.MISS)
+
+
+def test_cache_evicts_expired_and_oldest_entries(fake_clock):
+    cache = ReadThroughCache(lambda key: key, ttl=10, stale_ttl=10, max_entries=3, clock=fake_clock)
+    for key in range(5):
+        cache.get(key)
+    assert len(cache) == 3
+    assert cache.get(1) == (1, ReadThroughCache.MISS)
+
+    fake_clock.now = 25
+    cache.get('new')
+    assert len(cache) == 1
+
+
+def test_proxy_serves_from_cache(stub_server, proxy_server):
+    # keys of the client are not needed and not passed to Tilda
+    url = proxy_server.url + 'getpageslist/?projectid=1&publickey=client'
+    answer, cache_status = get(url)
+    assert answer == found([{'id': '1001', 'projectid': '1', 'version': 1}])
+    assert cache_status == 'MISS'
+
+    assert get(url) == (answer, 'HIT')
+    assert stub_server.count('getpageslist') == 1
+
+    # other parameters are cached separately
+    assert get(proxy_server.url + 'getpageslist/?projectid=2')[1] == 'MISS'
+    assert stub_server.count('getpageslist') == 2
+
+
+def test_proxy_stale_while_revalidate(stub_server, proxy_server, fake_clock):
+    url = proxy_server.url + 'getpageslist/?projectid=1'
+    get(url)
+
+    fake_clock.now = 50
+    answer, cache_status = get(url)
+    assert cache_status == 'STALE'
+    assert answer['result'][0]['version'] == 1
+    wait_for(lambda: get(url)[1] == 'HIT')
+    assert get(url)[0]['result'][0]['version'] == 2
+    assert stub_server.count('getpageslist') == 2
+
+    # too old to be returned
+    fake_clock.now = 200
+    assert get(url) == (found([{'id': '1001', 'projectid': '1', 'version': 3}]), 'MISS')
+
+
+def test_proxy_coalesces_client_requests(stub_server, proxy_server):
+    stub_server.handlers['getpage'] = lambda number, params: (200, found({'id': params['pageid']}), 0.3)
+    answers = []
+    threads = [
+        threading.Thread(target=lambda: answers.append(get(proxy_server.url + 'getpage/?pageid=1001')[0]))
+        for _ in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert answers == [found({'id': '1001'})] * 10
+    assert stub_server.count('getpage') == 1
+
+
+def test_proxy_errors(mocker, stub_server, proxy_server):
+    stub_server.handlers['getpage'] = lambda number, params: (200, {'status': 'ERROR', 'message': 'Page not found'})
+    assert get(proxy_server.url + 'getpage/?pageid=1')[0] == {'status': 'ERROR', 'message': 'Page not found'}
+
+    stub_server.handlers['getpagefull'] = lambda number, params: (500, {})
+    proxy_server.tilda_api.circuit_breaker = True
+    proxy_server.tilda_api.CIRCUIT_FAILURE_THRESHOLD = 1
+    with pytest.raises(HTTPError) as error:
+        get(proxy_server.url + 'getpagefull/?pageid=1')
+    assert error.value.code == 502
+    # the open circuit is not an answer of Tilda
+    with pytest.raises(HTTPError) as error:
+        get(proxy_server.url + 'getpagefull/?pageid=1')
+    assert error.value.code == 503
+
+    proxy_server.tilda_api._api_call = mocker.Mock(side_effect=TildaDeadlineExceeded('Deadline exceeded'))
+    with pytest.raises(HTTPError) as error:
+        get(proxy_server.url + 'getpageexport/?pageid=2')
+    assert error.value.code == 504
+
+    proxy_server.tilda_api._api_call = mocker.Mock(side_effect=IncompleteRead(b''))
+    with pytest.raises(HTTPError) as error:
+        get(proxy_server.url + 'getpageexport/?pageid=1')
+    assert error.value.code == 502
+
+    with pytest.raises(HTTPError) as error:
+        get(proxy_server.url + 'wrongname/')
+    assert error.value.code == 404
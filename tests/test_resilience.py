@@ -0,0 +1,168 @@
+import time
+from http.client import BadStatusLine
+from urllib.error import HTTPError, URLError
+
+import pytest
+
+from api import TildaApi
+from exceptions import TildaCircuitOpenException
+from resilience import LatencyTracker, CircuitBreaker, LRUCache
+from tests.conftest import found
+
+
+def test_latency_tracker_percentile():
+    tracker = LatencyTracker(window=100, min_samples=10)
+    for i in range(9):
+        tracker.add(i)
+    assert tracker.percentile(95) is None
+    for i in range(9, 100):
+        tracker.add(i)
+    assert tracker.percentile(95) == 94
+    assert tracker.percentile(50) == 49
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # 'b' is least recently used
+    assert 'b' not in cache
+    assert cache.get('b', 'missing') == 'missing'
+    assert len(cache) == 2
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+
+def test_circuit_breaker_opens_and_recovers(fake_clock):
+    clock = fake_clock
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=10, clock=clock)
+    breaker.record_failure(breaker.allow_request())
+    breaker.record_failure(breaker.allow_request())
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow_request() is None
+
+    clock.now = 10
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    trial = breaker.allow_request()
+    assert trial is not None
+    # only one trial request in half open state
+    assert breaker.allow_request() is None
+    breaker.record_failure(trial)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock.now = 20
+    breaker.record_success(breaker.allow_request())
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_circuit_breaker_ignores_late_outcomes(fake_clock):
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=10, clock=fake_clock)
+    late = breaker.allow_request()
+    breaker.record_failure(breaker.allow_request())
+
+    fake_clock.now = 10
+    trial = breaker.allow_request()
+    # the request sent before the circuit opened neither frees the trial slot nor closes the circuit
+    breaker.record_cancelled(late)
+    assert breaker.allow_request() is None
+    breaker.record_success(late)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.record_failure(late)
+    assert breaker.allow_request() is None
+
+    breaker.record_success(trial)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_hedged_request_returns_fastest_answer(stub_server, stub_api):
+    page = {'id': '1001', 'html': 'page'}
+    # the first request hangs, the hedged one is answered at once
+    stub_server.handlers['getpage'] = lambda number, params: (200, found(page), 1.0 if number == 1 else 0)
+    stub_api.hedge_requests = True
+    stub_api.HEDGE_DEFAULT_DELAY = 0.1
+
+    start = time.monotonic()
+    assert stub_api.get_page(page_id=1001) == page
+    assert time.monotonic() - start < 0.8
+    assert stub_server.count('getpage') == 2
+
+
+def test_hedged_request_not_sent_for_fast_answer(stub_server, stub_api):
+    stub_server.handlers['getpage'] = lambda number, params: (200, found({'id': params['pageid']}))
+    stub_api.hedge_requests = True
+    stub_api.HEDGE_DEFAULT_DELAY = 0.5
+
+    assert stub_api.get_page(page_id=1001) == {'id': '1001'}
+    assert stub_server.count('getpage') == 1
+
+
+def test_circuit_breaker_serves_cached_data(stub_server, stub_api):
+    projects = [{'id': '0', 'title': 'First Project', 'descr': ''}]
+    stub_server.handlers['getprojectslist'] = lambda number, params: (
+        (200, found(projects)) if number == 1 else (500, {})
+    )
+    stub_api.circuit_breaker = True
+    stub_api.CIRCUIT_FAILURE_THRESHOLD = 2
+
+    assert stub_api.get_projects_list() == projects
+    for _ in range(2):
+        with pytest.raises(HTTPError):
+            stub_api.get_projects_list()
+    # circuit is open: cached result without calling the API
+    assert stub_api.get_projects_list() == projects
+    assert stub_server.count('getprojectslist') == 3
+
+
+def test_circuit_breaker_fails_fast_without_cache(stub_server, stub_api):
+    stub_server.handlers['getpage'] = lambda number, params: (500, {})
+    stub_api.circuit_breaker = True
+    stub_api.CIRCUIT_FAILURE_THRESHOLD = 1
+
+    with pytest.raises(HTTPError):
+        stub_api.get_page(page_id=1)
+    with pytest.raises(TildaCircuitOpenException):
+        stub_api.get_page(page_id=1)
+    assert stub_server.count('getpage') == 1
+
+
+def test_circuit_breaker_counts_http_protocol_errors(mocker, stub_api):
+    mocker.patch('api.urlopen', side_effect=BadStatusLine('garbage'))
+    stub_api.circuit_breaker = True
+    stub_api.CIRCUIT_FAILURE_THRESHOLD = 1
+
+    with pytest.raises(BadStatusLine):
+        stub_api.get_page(page_id=1)
+    with pytest.raises(TildaCircuitOpenException):
+        stub_api.get_page(page_id=1)
+
+
+def test_circuit_breaker_trial_slot_freed_on_other_errors(mocker, stub_api):
+    urlopen = mocker.patch('api.urlopen', side_effect=URLError('down'))
+    stub_api.circuit_breaker = True
+    stub_api.CIRCUIT_FAILURE_THRESHOLD = 1
+    stub_api.CIRCUIT_RECOVERY_TIMEOUT = 0
+    with pytest.raises(URLError):
+        stub_api.get_page(page_id=1)
+
+    # the trial request fails with an error which says nothing about the endpoint
+    urlopen.side_effect = RuntimeError('bug')
+    with pytest.raises(RuntimeError):
+        stub_api.get_page(page_id=1)
+    assert stub_api._circuit_breakers[TildaApi.GET_PAGE].allow_request() is not None
+
+
+def test_trial_request_is_not_hedged(stub_server, stub_api):
+    stub_server.handlers['getpage'] = lambda number, params: (
+        (500, {}) if number == 1 else (200, found({'id': params['pageid']}), 0.3)
+    )
+    stub_api.hedge_requests = True
+    stub_api.HEDGE_DEFAULT_DELAY = 0.05
+    stub_api.circuit_breaker = True
+    stub_api.CIRCUIT_FAILURE_THRESHOLD = 1
+    stub_api.CIRCUIT_RECOVERY_TIMEOUT = 0
+    with pytest.raises(HTTPError):
+        stub_api.get_page(page_id=1001)
+
+    assert stub_api.get_page(page_id=1001) == {'id': '1001'}
+    assert stub_server.count('getpage') == 2
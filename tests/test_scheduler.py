@@ -0,0 +1,171 @@
+import threading
+import time
+
+import pytest
+
+from api import TildaApi
+from bulk import Deadline
+from exceptions import TildaCircuitOpenException, TildaDeadlineExceeded
+from scheduler import RequestScheduler, INTERACTIVE, DEFAULT, BULK, priority, current_priority
+from tests.conftest import found
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = RequestScheduler(workers=1)
+    yield scheduler
+    scheduler.shutdown()
+
+
+def test_priority_context():
+    assert current_priority() == DEFAULT
+    with priority(INTERACTIVE):
+        assert current_priority() == INTERACTIVE
+        with priority(BULK, override=False):
+            assert current_priority() == INTERACTIVE
+        with priority(BULK):
+            assert current_priority() == BULK
+    with priority(BULK, override=False):
+        assert current_priority() == BULK
+
+
+def test_interactive_preempts_and_fair_queuing(scheduler):
+    # the only worker is busy while requests are queued
+    release = threading.Event()
+    scheduler.submit(release.wait)
+    order = []
+    futures = [scheduler.submit(order.append, 'bulk', level=BULK) for _ in range(5)]
+    futures += [scheduler.submit(order.append, 'default', level=DEFAULT) for _ in range(8)]
+    futures += [scheduler.submit(order.append, 'interactive', level=INTERACTIVE) for _ in range(2)]
+    release.set()
+    for future in futures:
+        future.result()
+
+    # interactive requests overtake queued ones, the rest share the budget 4:1
+    assert order[:2] == ['interactive'] * 2
+    assert order[2:12].count('default') == 8
+    assert order[2:12].count('bulk') == 2
+    assert order[12:] == ['bulk'] * 3
+
+
+def test_rate_limit():
+    scheduler = RequestScheduler(workers=4, rate=20)
+    try:
+        start = time.monotonic()
+        for future in [scheduler.submit(lambda: None) for _ in range(5)]:
+            future.result()
+        # the first request is sent at once, the rest wait for tokens
+        assert time.monotonic() - start >= 0.19
+    finally:
+        scheduler.shutdown()
+
+
+def test_errors_and_stats(scheduler):
+    with pytest.raises(ZeroDivisionError):
+        scheduler.run(lambda: 1 / 0, level=BULK)
+    assert scheduler.run(lambda: 42) == 42
+    with pytest.raises(ValueError):
+        scheduler.submit(lambda: None, level='unknown')
+
+    stats = scheduler.stats()
+    assert stats[BULK]['submitted'] == stats[BULK]['completed'] == 1
+    assert stats[DEFAULT]['completed'] == 1
+    assert stats[INTERACTIVE]['submitted'] == 0
+    assert stats[DEFAULT]['queued'] == 0
+    assert stats[DEFAULT]['wait_max'] >= stats[DEFAULT]['wait_avg'] >= 0
+
+
+def test_interactive_request_during_bulk_sync(stub_server, stub_api):
+    stub_server.handlers['getpageslist'] = lambda number, params: (200, found([{'id': i} for i in range(30)]))
+    stub_server.handlers['getprojectinfo'] = lambda number, params: (200, found({}))
+    stub_server.handlers['getpagefullexport'] = lambda number, params: (200, found({'id': params['pageid']}))
+    stub_server.handlers['getpage'] = lambda number, params: (200, found({'id': params['pageid']}))
+    scheduler = RequestScheduler(workers=2, rate=20)
+    stub_api.scheduler = scheduler
+    # every bulk thread blocks on its queued request, so queue depth is limited by the number of threads
+    stub_api.BULK_WORKERS = 8
+    try:
+        sync = threading.Thread(target=stub_api.sync_project, args=(1,))
+        sync.start()
+        # wait until bulk requests are queued
+        for _ in range(200):
+            if scheduler.stats()[BULK]['queued'] >= 5:
+                break
+            time.sleep(0.01)
+        else:
+            raise AssertionError('bulk requests are not queued')
+
+        start = time.monotonic()
+        with priority(INTERACTIVE):
+            assert stub_api.get_page(page_id=1001) == {'id': '1001'}
+        assert time.monotonic() - start < 0.5
+        assert scheduler.stats()[BULK]['queued'] > 0
+        sync.join()
+    finally:
+        scheduler.shutdown()
+
+    stats = scheduler.stats()
+    assert stats[BULK]['completed'] == 32
+    assert stats[INTERACTIVE]['wait_max'] < stats[BULK]['wait_max']
+
+
+def test_interactive_request_while_workers_send_slow_bulk_requests(stub_server, stub_api):
+    stub_server.handlers['getpageslist'] = lambda number, params: (200, found([{'id': i} for i in range(4)]))
+    stub_server.handlers['getprojectinfo'] = lambda number, params: (200, found({}))
+    stub_server.handlers['getpagefullexport'] = lambda number, params: (200, found({'id': params['pageid']}), 0.4)
+    stub_server.handlers['getpage'] = lambda number, params: (200, found({'id': params['pageid']}))
+    scheduler = RequestScheduler(workers=2)
+    stub_api.scheduler = scheduler
+    try:
+        sync = threading.Thread(target=stub_api.sync_project, args=(1,))
+        sync.start()
+        for _ in range(200):
+            if scheduler.stats()[BULK]['queued'] >= 2:
+                break
+            time.sleep(0.01)
+        else:
+            raise AssertionError('bulk requests are not queued')
+
+        # a slow bulk request is in progress, the reserved worker sends the interactive one at once
+        start = time.monotonic()
+        with priority(INTERACTIVE):
+            assert stub_api.get_page(page_id=1001) == {'id': '1001'}
+        assert time.monotonic() - start < 0.3
+        sync.join()
+    finally:
+        scheduler.shutdown()
+
+
+def test_queued_requests_cancelled_on_deadline(stub_server, stub_api):
+    stub_server.handlers['getpage'] = lambda number, params: (200, found({'id': params['pageid']}))
+    scheduler = RequestScheduler(workers=2, rate=4)
+    stub_api.scheduler = scheduler
+    try:
+        result = stub_api.get_pages_bulk(range(12), api_name=TildaApi.GET_PAGE, deadline=Deadline(0.5))
+        sent = stub_server.count('getpage')
+        assert len(result.missing) == 12 - len(result.results)
+        assert sent < 12
+        # abandoned requests don't spend the rate budget
+        time.sleep(1)
+        assert stub_server.count('getpage') == sent
+        assert scheduler.stats()[BULK]['cancelled'] > 0
+    finally:
+        scheduler.shutdown()
+
+
+def test_upstream_timeout_is_not_deadline(stub_server, stub_api):
+    stub_server.handlers['getpage'] = lambda number, params: (200, found({'id': params['pageid']}), 1)
+    scheduler = RequestScheduler(workers=1)
+    stub_api.scheduler = scheduler
+    stub_api.circuit_breaker = True
+    stub_api.CIRCUIT_FAILURE_THRESHOLD = 1
+    stub_api.TIMEOUT = 0.2
+    try:
+        # timeout of Tilda itself is a failure of the endpoint, not an exceeded deadline
+        with pytest.raises(TimeoutError) as exc_info:
+            stub_api.get_page(page_id=1001)
+        assert not isinstance(exc_info.value, TildaDeadlineExceeded)
+        with pytest.raises(TildaCircuitOpenException):
+            stub_api.get_page(page_id=1001)
+    finally:
+        scheduler.shutdown()
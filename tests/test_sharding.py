@@ -0,0 +1,107 @@
+import sqlite3
+import threading
+
+import pytest
+
+from sharding import LeaseStore, ShardedSync
+from tests.conftest import found
+
+PROJECT_IDS = [str(project_id) for project_id in range(10)]
+
+
+@pytest.fixture
+def stub_api(stub_api, stub_server):
+    stub_server.handlers['getprojectslist'] = lambda number, params: (
+        200, found([{'id': project_id} for project_id in PROJECT_IDS])
+    )
+    stub_server.handlers['getprojectinfo'] = lambda number, params: (200, found({'id': params['projectid']}))
+    stub_server.handlers['getpageslist'] = lambda number, params: (
+        200, found([{'id': params['projectid'] + '001'}])
+    )
+    stub_server.handlers['getpagefullexport'] = lambda number, params: (200, found({'id': params['pageid']}), 0.01)
+    return stub_api
+
+
+def test_lease_store(tmp_path, fake_clock):
+    store = LeaseStore(str(tmp_path / 'leases.sqlite'), lease_ttl=10, clock=fake_clock)
+    assert store.acquire('run', '1', 'a')
+    assert not store.acquire('run', '1', 'b')
+    # the same project in another run is free
+    assert store.acquire('other run', '1', 'b')
+
+    fake_clock.now = 5
+    assert store.renew('run', '1', 'a')
+    fake_clock.now = 14
+    assert not store.acquire('run', '1', 'b')
+
+    # lease of dead worker expired
+    fake_clock.now = 16
+    assert not store.renew('run', '1', 'a')
+    assert store.acquire('run', '1', 'b')
+    assert not store.complete('run', '1', 'a')
+    assert store.complete('run', '1', 'b')
+    assert store.done_projects('run') == {'1'}
+
+    fake_clock.now = 100
+    assert not store.acquire('run', '1', 'a')
+
+
+def test_workers_do_not_duplicate_work(tmp_path, stub_server, stub_api):
+    store = LeaseStore(str(tmp_path / 'leases.sqlite'))
+    results = {}
+
+    def worker(worker_id):
+        sync = ShardedSync(stub_api, store, run_id='run', worker_id=worker_id)
+        sync.POLL_INTERVAL = 0.05
+        results[worker_id] = sync.run()
+
+    threads = [threading.Thread(target=worker, args=(str(i),)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    synced = [project_id for result in results.values() for project_id in result.results]
+    assert sorted(synced) == sorted(PROJECT_IDS)
+    assert all(result.complete for result in results.values())
+    assert stub_server.count('getprojectinfo') == len(PROJECT_IDS)
+    assert store.done_projects('run') == set(PROJECT_IDS)
+
+
+def test_worker_takes_over_dead_worker_shard(tmp_path, stub_server, stub_api):
+    store = LeaseStore(str(tmp_path / 'leases.sqlite'), lease_ttl=0.3)
+    # dead worker holds lease of the project and never renews it
+    assert store.acquire('run', '3', 'dead')
+
+    sync = ShardedSync(stub_api, store, run_id='run', worker_id='alive')
+    sync.POLL_INTERVAL = 0.05
+    result = sync.run()
+    assert sorted(result.results) == sorted(PROJECT_IDS)
+    assert stub_server.count('getprojectinfo') == len(PROJECT_IDS)
+
+
+def test_failed_project_is_released(tmp_path, stub_server, stub_api):
+    stub_server.handlers['getprojectinfo'] = lambda number, params: (
+        200, {'status': 'ERROR', 'message': 'error'} if params['projectid'] == '5' else found({})
+    )
+    store = LeaseStore(str(tmp_path / 'leases.sqlite'))
+
+    result = ShardedSync(stub_api, store, run_id='run', worker_id='a').run()
+    assert result.missing == ['5']
+    assert '5' in result.errors
+    assert store.acquire('run', '5', 'b')
+
+
+def test_sync_stops_when_lease_is_lost(mocker, tmp_path, stub_server, stub_api):
+    stub_server.handlers['getprojectslist'] = lambda number, params: (200, found([{'id': '1'}]))
+    stub_server.handlers['getpageslist'] = lambda number, params: (200, found([{'id': i} for i in range(20)]))
+    stub_server.handlers['getpagefullexport'] = lambda number, params: (200, found({'id': params['pageid']}), 0.05)
+    stub_api.BULK_WORKERS = 1
+    store = LeaseStore(str(tmp_path / 'leases.sqlite'), lease_ttl=0.3)
+    mocker.patch.object(store, 'renew', side_effect=sqlite3.OperationalError('database is locked'))
+
+    result = ShardedSync(stub_api, store, run_id='run', worker_id='a').run()
+    assert result.missing == ['1']
+    # the sync stopped before the lease expired, so no page is fetched by two workers
+    assert stub_server.count('getpagefullexport') < 10
+    assert store.done_projects('run') == set()
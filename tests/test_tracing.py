@@ -0,0 +1,102 @@
+import io
+import json
+from urllib.error import HTTPError
+
+import pytest
+
+from api import TildaApi
+from tracing import Tracer
+from tests.conftest import found
+
+PHASES = ['dns', 'connect', 'send', 'ttfb', 'body', 'json.loads']
+
+
+@pytest.fixture
+def tracer():
+    return Tracer()
+
+
+@pytest.fixture
+def stub_api(stub_api, stub_server, tracer):
+    stub_server.handlers['getpage'] = lambda number, params: (200, found({'id': params['pageid']}))
+    stub_api.tracer = tracer
+    return stub_api
+
+
+def children(tracer, span):
+    return [child for child in tracer.spans if child.parent_id == span.span_id]
+
+
+def test_nested_spans(tracer):
+    with tracer.span('parent') as parent:
+        with tracer.span('child', key='value') as child:
+            pass
+    with pytest.raises(ValueError):
+        with tracer.span('failed'):
+            raise ValueError('error')
+
+    assert [span.name for span in tracer.spans] == ['child', 'parent', 'failed']
+    assert parent.parent_id is None
+    assert child.parent_id == parent.span_id
+    assert child.attributes == {'key': 'value'}
+    assert 'error' in tracer.spans[-1].attributes
+    assert parent.duration >= child.duration
+
+
+def test_api_call_phases(stub_api, tracer):
+    assert stub_api.get_page(page_id=1001) == {'id': '1001'}
+
+    api_call = next(span for span in tracer.spans if span.name == 'api_call')
+    assert api_call.attributes['api_name'] == 'getpage'
+    assert [span.name for span in children(tracer, api_call)] == PHASES
+
+
+def test_traced_http_error(stub_server, stub_api):
+    stub_server.handlers['getpage'] = lambda number, params: (500, {})
+    with pytest.raises(HTTPError):
+        stub_api.get_page(page_id=1001)
+
+
+def test_traced_request_follows_redirects(stub_server, stub_api, tracer):
+    stub_server.handlers['getpage'] = lambda number, params: (
+        302, {}, 0, {'Location': stub_server.url + 'getpagefull/?pageid=' + params['pageid']}
+    )
+    stub_server.handlers['getpagefull'] = lambda number, params: (200, found({'full': params['pageid']}))
+
+    assert stub_api.get_page(page_id=1001) == {'full': '1001'}
+    assert [span.name for span in tracer.spans].count('ttfb') == 2
+
+
+def test_traced_request_uses_proxy_from_environment(monkeypatch, stub_server, stub_api):
+    monkeypatch.setenv('http_proxy', stub_server.url.replace('/v1/', ''))
+    monkeypatch.delenv('no_proxy', raising=False)
+    monkeypatch.delenv('NO_PROXY', raising=False)
+    stub_api.TILDA_API_DOMEN = 'http://tilda.invalid/v1/'
+
+    assert stub_api.get_page(page_id=1001) == {'id': '1001'}
+    assert stub_server.count('getpage') == 1
+
+
+def test_bulk_spans_linked_across_threads(stub_api, tracer):
+    stub_api.get_pages_bulk([1, 2, 3], api_name=TildaApi.GET_PAGE)
+
+    bulk = next(span for span in tracer.spans if span.name == 'get_pages_bulk')
+    api_calls = children(tracer, bulk)
+    assert len(api_calls) == 3
+    assert all(span.name == 'api_call' for span in api_calls)
+    assert {span.thread_id for span in api_calls} != {bulk.thread_id}
+
+
+def test_export(stub_api, tracer):
+    stub_api.get_page(page_id=1001)
+
+    lines = io.StringIO()
+    tracer.export_json_lines(lines)
+    spans = [json.loads(line) for line in lines.getvalue().splitlines()]
+    assert [span['name'] for span in spans] == PHASES + ['api_call']
+
+    chrome_trace = io.StringIO()
+    tracer.export_chrome_trace(chrome_trace)
+    events = json.loads(chrome_trace.getvalue())['traceEvents']
+    assert len(events) == len(spans)
+    assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in events)
@@ -0,0 +1,220 @@
+"""
+Tracing of Tilda API calls with timing of every phase of the request.
+
+Трассировка вызовов API Тильды с замером каждой фазы запроса.
+
+Spans: api call -> dns, connect, tls, send, ttfb (time to first byte), body, json.loads.
+The parent of a span is the span active in the current context, bulk operations pass the context
+to their worker threads, so spans of a full sync form one tree.
+Спан-родитель берется из текущего контекста, массовые операции передают контекст в потоки,
+поэтому спаны всей синхронизации образуют одно дерево.
+
+Usage/Использование:
+
+tracer = Tracer()
+tilda_api = TildaApi(tracer=tracer)
+tilda_api.sync_project(project_id=1)
+with open('trace.json', 'w') as f:
+    tracer.export_chrome_trace(f)  # open in chrome://tracing or https://ui.perfetto.dev
+"""
+import contextlib
+import contextvars
+import functools
+import http.client
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+import typing as t
+import urllib.request
+
+_current_span = contextvars.ContextVar('tilda_current_span', default=None)
+
+
+class Span:
+
+    def __init__(self, span_id: int, name: str, parent_id: t.Optional[int], attributes: t.Dict):
+        self.span_id = span_id
+        self.name = name
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.thread_id = threading.get_ident()
+        self.start = time.time()
+        self.duration = None
+        self._started = time.perf_counter()
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._started
+
+    def to_dict(self) -> t.Dict:
+        return {
+            'id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'thread_id': self.thread_id,
+            'attributes': self.attributes,
+        }
+
+
+class Tracer:
+    """
+    Collect spans of Tilda API calls.
+    Сбор спанов вызовов API Тильды
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """
+        Measure the block of code, spans opened inside it become its children.
+        Замер блока кода, спаны внутри него становятся дочерними
+        """
+        parent = _current_span.get()
+        span = Span(next(self._ids), name, parent.span_id if parent is not None else None, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.attributes['error'] = repr(exc)
+            raise
+        finally:
+            span.finish()
+            _current_span.reset(token)
+            with self._lock:
+                self.spans.append(span)
+
+    def export_json_lines(self, fileobj: t.TextIO):
+        """
+        Write spans as JSON lines, one span per line.
+        Запись спанов в формате JSON lines, по спану на строку
+        """
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            fileobj.write(json.dumps(span.to_dict()) + '\n')
+
+    def export_chrome_trace(self, fileobj: t.TextIO):
+        """
+        Write spans in Chrome trace event format.
+        Запись спанов в формате Chrome trace
+        """
+        with self._lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        events = [
+            {
+                'name': span.name,
+                'cat': 'tilda',
+                'ph': 'X',
+                'ts': span.start * 1e6,
+                'dur': span.duration * 1e6,
+                'pid': pid,
+                'tid': span.thread_id,
+                'args': dict(span.attributes, id=span.span_id, parent_id=span.parent_id),
+            }
+            for span in spans
+        ]
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fileobj)
+
+
+class _TracedConnectMixin:
+    """
+    Connection which measures every phase of the request separately.
+    Соединение, в котором отдельно замеряется каждая фаза запроса
+    """
+
+    def __init__(self, *args, tracer: Tracer, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._tracer = tracer
+
+    def _traced_connect(self):
+        with self._tracer.span('dns', host=self.host):
+            addresses = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        with self._tracer.span('connect'):
+            error = None
+            for family, sock_type, proto, _, address in addresses:
+                sock = socket.socket(family, sock_type, proto)
+                try:
+                    sock.settimeout(self.timeout)
+                    sock.connect(address)
+                except OSError as exc:
+                    sock.close()
+                    error = exc
+                    continue
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.sock = sock
+                break
+            else:
+                raise error
+            if self._tunnel_host:
+                # CONNECT through https proxy
+                self._tunnel()
+
+    def request(self, *args, **kwargs):
+        # connect before sending, so dns and connect are not counted as send
+        if self.sock is None:
+            self.connect()
+        with self._tracer.span('send'):
+            super().request(*args, **kwargs)
+
+    def getresponse(self):
+        with self._tracer.span('ttfb'):
+            return super().getresponse()
+
+
+class _TracedHTTPConnection(_TracedConnectMixin, http.client.HTTPConnection):
+
+    def connect(self):
+        self._traced_connect()
+
+
+class _TracedHTTPSConnection(_TracedConnectMixin, http.client.HTTPSConnection):
+
+    def connect(self):
+        self._traced_connect()
+        with self._tracer.span('tls'):
+            self.sock = self._context.wrap_socket(self.sock, server_hostname=self._tunnel_host or self.host)
+
+
+class _TracedHTTPHandler(urllib.request.HTTPHandler):
+
+    def __init__(self, tracer: Tracer):
+        super().__init__()
+        self._tracer = tracer
+
+    def http_open(self, req):
+        return self.do_open(functools.partial(_TracedHTTPConnection, tracer=self._tracer), req)
+
+
+class _TracedHTTPSHandler(urllib.request.HTTPSHandler):
+
+    def __init__(self, tracer: Tracer):
+        super().__init__()
+        self._tracer = tracer
+
+    def https_open(self, req):
+        return self.do_open(functools.partial(_TracedHTTPSConnection, tracer=self._tracer), req,
+                            context=self._context)
+
+
+def traced_get(tracer: Tracer, url: str, timeout: float) -> bytes:
+    """
+    GET request with a span for every phase.
+    The request goes through urllib opener, so redirects, proxies from environment and http errors
+    are handled the same way as by urlopen.
+    GET-запрос со спаном на каждую фазу. Редиректы, прокси из окружения и http-ошибки
+    обрабатываются так же, как в urlopen
+    :return: bytes - body of the answer
+    """
+    opener = urllib.request.build_opener(_TracedHTTPHandler(tracer), _TracedHTTPSHandler(tracer))
+    with opener.open(url, timeout=timeout) as resp:
+        with tracer.span('body'):
+            return resp.read()